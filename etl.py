@@ -1,197 +1,256 @@
-import configparser
 from datetime import datetime
-import os
+import logging
+from pyspark import StorageLevel, __version__ as pyspark_version
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, desc, row_number, monotonically_increasing_id
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek, date_format, to_timestamp, to_date
-from pyspark.sql.window import Window
+from pyspark.sql.functions import udf, col, struct, broadcast, xxhash64, max as smax, min as smin
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek, date_format
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType
 
 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-os.environ['AWS_ACCESS_KEY_ID']=config.get('USER', 'AWS_ACCESS_KEY_ID')
-os.environ['AWS_SECRET_ACCESS_KEY']=config.get('USER', 'AWS_SECRET_ACCESS_KEY')
+# explicit schemas of the input json files, so spark does not run a schema inference pass over S3
+SONG_SCHEMA = StructType([
+    StructField("num_songs", LongType()),
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_name", StringType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("year", LongType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", LongType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("status", LongType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType())
+])
 
 
 def create_spark_session():
     """Starts a spark session"""
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.jars.packages", f"org.apache.hadoop:hadoop-aws:3.3.4,org.apache.spark:spark-hadoop-cloud_2.12:{pyspark_version}") \
+        .config("spark.hadoop.fs.s3a.aws.credentials.provider", "com.amazonaws.auth.DefaultAWSCredentialsProviderChain") \
+        .config("spark.hadoop.fs.s3a.connection.ssl.enabled", "true") \
+        .config("spark.hadoop.fs.s3a.connection.maximum", "200") \
+        .config("spark.hadoop.fs.s3a.threads.max", "64") \
+        .config("spark.hadoop.mapreduce.input.fileinputformat.list-status.num-threads", "32") \
+        .config("spark.hadoop.fs.s3a.experimental.input.fadvise", "normal") \
+        .config("spark.hadoop.fs.s3a.fast.upload.buffer", "disk") \
+        .config("spark.hadoop.fs.s3a.multipart.size", "67108864") \
+        .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+        .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+        .config("spark.sql.sources.commitProtocolClass", "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol") \
+        .config("spark.sql.parquet.output.committer.class", "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter") \
+        .config("spark.sql.sources.parallelPartitionDiscovery.threshold", "0") \
+        .config("spark.sql.files.ignoreCorruptFiles", "true") \
+        .config("spark.sql.autoBroadcastJoinThreshold", "209715200") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.skewedPartitionFactor", "5") \
+        .config("spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes", "256MB") \
+        .config("spark.sql.adaptive.localShuffleReader.enabled", "true") \
+        .config("spark.sql.inMemoryColumnarStorage.batchSize", "8192") \
+        .config("spark.sql.parquet.columnarReaderBatchSize", "8192") \
+        .config("spark.sql.files.maxPartitionBytes", "268435456") \
+        .config("spark.sql.files.openCostInBytes", "1048576") \
+        .config("spark.hadoop.mapreduce.fileoutputcommitter.marksuccessfuljobs", "false") \
+        .config("spark.hadoop.parquet.enable.summary-metadata", "false") \
+        .config("spark.sql.parquet.mergeSchema", "false") \
+        .config("spark.sql.parquet.compression.codec", "zstd") \
+        .config("spark.hadoop.parquet.compression", "zstd") \
+        .config("spark.io.compression.codec", "zstd") \
         .getOrCreate()
     return spark
 
 
 def process_song_data(spark, input_data, output_data):
-    """Instructions to ETL song data. Reads song data from input_data S3 bucket into a pyspark dataframe. Selects and transforms columns into songs and artists tables exported as parquet files on output_data S3 bucket."""
+    """Instructions to ETL song data. Reads song data from input_data S3 bucket into a pyspark dataframe. Selects and transforms columns into songs and artists tables exported as parquet files on output_data S3 bucket. Returns the cached song data dataframe so it can be reused for the songplays table; the caller is responsible for unpersisting it."""
     
     # get filepath to song data file
     song_data = f"{input_data}/song_data/*/*/*/*.json"
     
     # read song data file
-    df = spark.read.json(song_data)
-    print("Song data load to df")
+    df = spark.read.schema(SONG_SCHEMA).json(song_data)
+    logger.info("Song data load to df")
+    
+    # keep only columns used by songs, artists and songplays tables and cache them, so S3 is read once
+    df = df \
+            .select(["song_id", "title", "artist_id", "year", "duration", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]) \
+            .persist(StorageLevel.MEMORY_AND_DISK)
     
     # extract columns to create songs table
     songs_table = df.select(["song_id", "title", "artist_id", "year", "duration", "artist_name"])
-    print("Song table selected")
+    logger.info("Song table selected")
     
     # drop duplicates from songs table
     songs_table = songs_table.dropDuplicates(["song_id"])
-    print("Song table duplicates removed")
-    
-    print("Song table writing to parquet")
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_name").parquet(f"{output_data}/songs_table.parquet")
-    print("Writing to parquet completed!")
-    
-    # extract columns to create artists table
-    artists_table = df.select(["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]) 
-    print("Artists table selected")
-    
-    # rename columns dropping artist prefix
-    artists_table = artists_table \
-                        .withColumnRenamed("artist_name", "name") \
-                        .withColumnRenamed("artist_location", "location") \
-                        .withColumnRenamed("artist_latitude", "latitude") \
-                        .withColumnRenamed("artist_longitude", "longitude")
-    
-    print("Artist table columns renamed")
-                                 
-                                             
+    logger.info("Song table duplicates removed")
+    
+    logger.info("Song table writing to parquet")
+    # write songs table to parquet files partitioned by year and artist id
+    songs_table.write.partitionBy("year", "artist_id").parquet(f"{output_data}/songs_table.parquet")
+    logger.info("Writing to parquet completed!")
+    
+    # extract columns to create artists table, renaming columns to drop artist prefix
+    artists_table = df.selectExpr("artist_id", "artist_name AS name", "artist_location AS location",
+                                  "artist_latitude AS latitude", "artist_longitude AS longitude")
+    logger.info("Artists table selected")
+    
     # drop duplicates from artist table
     artists_table = artists_table.dropDuplicates(["artist_id"])
-    print("Artists table duplicates removed")
+    logger.info("Artists table duplicates removed")
     
-    print("Artists table writing to parquet")
+    logger.info("Artists table writing to parquet")
     # write artists table to parquet files
     artists_table.write.parquet(f"{output_data}/artists_table.parquet")
-    print("Writing to parquet completed!")
+    logger.info("Writing to parquet completed!")
+    
+    return df
 
-def process_log_data(spark, input_data, output_data):
-    """Instructions to ETL log data. Reads log data from input_data S3 bucket into a pyspark dataframe. Selects and transforms columns into users, time and songplays tables exported as parquet files on output_data S3 bucket. The songplay table uses columns from both log data and song data sources."""
+def process_log_data(spark, input_data, output_data, song_df):
+    """Instructions to ETL log data. Reads log data from input_data S3 bucket into a pyspark dataframe. Selects and transforms columns into users, time and songplays tables exported as parquet files on output_data S3 bucket. The songplay table uses columns from both log data and the song_df dataframe returned by process_song_data."""
     
     # get filepath to log data file
     log_data = f"{input_data}/log_data/*/*/*.json"
     
-    # read log data file
-    df = spark.read.json(log_data)
-    print("Log data load to df")
+    # timestamp from original ts column, ts is unix time in milliseconds
+    start_time = (col("ts") / 1000).cast("timestamp")
     
-    # filter by actions for song plays
-    df = df.filter(df.page == "NextSong")
-    print("Log df filtered NextSong only")
+    # read log data file
+    df = spark.read.schema(LOG_SCHEMA).json(log_data)
+    logger.info("Log data load to df")
     
-    # rename columns
+    # keep only needed columns and filter by actions for song plays
     df = df \
-            .withColumnRenamed("firstName", "first_name") \
-            .withColumnRenamed("lastName", "last_name") \
-            .withColumnRenamed("sessionId", "session_id") \
-            .withColumnRenamed("userAgent", "user_agent") \
-            .withColumnRenamed("userId", "user_id")
+            .select(["ts", "userId", "firstName", "lastName", "gender", "level", "sessionId", "location", "userAgent", "song", "artist", "page"]) \
+            .filter(col("page") == "NextSong") \
+            .drop("page")
+    logger.info("Log df filtered NextSong only")
     
-    print("Log df columns renamed")
+    # rename columns in a single projection
+    df = df.selectExpr("ts", "userId AS user_id", "firstName AS first_name", "lastName AS last_name", "gender", "level",
+                       "sessionId AS session_id", "location", "userAgent AS user_agent", "song", "artist")
+    
+    logger.info("Log df columns renamed")
 
     # extract columns for users table    
     users_table = df.select(["user_id", "first_name", "last_name", "gender", "level", "ts"])
-    print("Users table selected")
-    
-    print("Opening window on users table")
-    # ensure the latest information on the user is kept while removing duplicates                                 
-    # Define a window specification to
-    window_spec = Window.partitionBy("user_id").orderBy(desc("ts"))
-
-    # Add a row number column based on the window specification
-    users_table = users_table.withColumn("row_number", row_number().over(window_spec))
-
-    # Filter the DataFrame to keep only the rows with row_number = 1
-    users_table = users_table.filter(users_table.row_number == 1)
-
-    # Drop the row_number column
-    users_table = users_table.drop(*["row_number", "ts"])
-    print("Window completed")
-    
-    print("Users table writing to parquet")
+    logger.info("Users table selected")
+    
+    logger.info("Aggregating latest user info")
+    # ensure the latest information on the user is kept while removing duplicates
+    # max of a struct compares ts first, so it picks the row of the latest event without sorting
+    users_table = users_table \
+                    .groupBy("user_id") \
+                    .agg(smax(struct("ts", "first_name", "last_name", "gender", "level")).alias("latest")) \
+                    .select("user_id", "latest.first_name", "latest.last_name", "latest.gender", "latest.level")
+    logger.info("Aggregation completed")
+    
+    logger.info("Users table writing to parquet")
     # write users table to parquet files
     users_table.write.parquet(f"{output_data}/users_table.parquet")
-    print("Writing to parquet completed!")
+    logger.info("Writing to parquet completed!")
     
-    print("Extract from datetime starting")
+    logger.info("Extract from datetime starting")
     # create timestamp column from original timestamp column
-    # get_timestamp = udf(lambda x: datetime.timestamp(x)) # amend udf
-    # df = df.withColumn("start_time", get_timestamp(df.ts))
-    df = df.withColumn("start_time", to_timestamp(df.ts))
-    
-    # create datetime column from original timestamp column
-    #get_datetime = udf(lambda x: datetime.fromtimestamp(x / 1000.0))
-    # df = df.withColumn("datetime", get_datetime(df.ts))
-    df = df.withColumn("datetime", to_date(df.start_time))
-    
-    # extract from datetime
+    # year and month are kept on log df for partitioning songplays table
     df = df \
-            .withColumn("hour", hour(df.datetime)) \
-            .withColumn("day", dayofmonth(df.datetime)) \
-            .withColumn("week", weekofyear(df.datetime)) \
-            .withColumn("month", month(df.datetime)) \
-            .withColumn("year", hour(df.datetime)) \
-            .withColumn("weekday", dayofweek(df.datetime))
-    
-    print("Extract from datetime completed")
-    
-    # extract columns to create time table
-    time_table = df.select(["start_time", "hour", "day", "week", "month", "year", "weekday"])
-    print("Time table selected")
-    
-    # drop duplicates from time table 
-    time_table = time_table.dropDuplicates(["start_time"])
-    print("Time table duplicates removed")
-    
-    print("Time table writing to parquet")
+            .withColumn("start_time", start_time) \
+            .withColumn("year", year(col("start_time"))) \
+            .withColumn("month", month(col("start_time")))
+    
+    # remove duplicates on the narrow ts column only, before widening rows with calendar fields
+    time_table = df.select("ts").distinct()
+    logger.info("Time table duplicates removed")
+    
+    # extract from timestamp to create time table
+    time_table = time_table \
+            .withColumn("start_time", start_time) \
+            .select("start_time",
+                    hour("start_time").alias("hour"),
+                    dayofmonth("start_time").alias("day"),
+                    weekofyear("start_time").alias("week"),
+                    month("start_time").alias("month"),
+                    year("start_time").alias("year"),
+                    dayofweek("start_time").alias("weekday"))
+    
+    logger.info("Extract from datetime completed")
+    
+    # repartition by output partition columns so each year/month is written by one task, as a single file
+    time_table = time_table.repartition("year", "month")
+    
+    logger.info("Time table writing to parquet")
     # write time table to parquet files partitioned by year and month
     time_table.write.partitionBy("year", "month").parquet(f"{output_data}/time_table.parquet")
-    print("Writing to parquet completed!")
-    
-    # get filepath to song data file
-    song_data = f"{input_data}/song_data/*/*/*/*.json"
-    
-    # read in song data to use for songplays table
-    song_df = spark.read.json(song_data)
-    
-    # in song df rename year column to avoid ambiguity
-    song_df = song_df.withColumnRenamed("year", "album_year")
+    logger.info("Writing to parquet completed!")
+    
+    # keep only song df columns needed for the join, which also avoids ambiguity on year column
+    # one row per title and artist name, so the join yields at most one row per log event and songplay_id stays unique
+    # min of a struct picks the same song on every rerun when several songs share title and artist name
+    song_small = song_df \
+                    .groupBy("title", "artist_name") \
+                    .agg(smin(struct("song_id", "artist_id")).alias("song")) \
+                    .select("title", "artist_name", "song.song_id", "song.artist_id")
 
-    # Create songplay df by joining both tables
-    songplay_df = df.join(song_df, [(df.song == song_df.title), (df.artist == song_df.artist_name)], "left")
+    # Create songplay df by joining both tables, broadcasting the small song side to avoid shuffling log df
+    songplay_df = df.join(broadcast(song_small), [(df.song == song_small.title), (df.artist == song_small.artist_name)], "left")
     
     # extract columns from joined song and log datasets to create songplays table 
     songplays_table = songplay_df.select(["start_time", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent", "year", "month"])
     
-    # add songplay_id column with unique id
-    songplays_table = songplays_table.withColumn("songplay_id", monotonically_increasing_id())
+    # add songplay_id column with deterministic id hashed from the natural key
+    songplays_table = songplays_table.withColumn("songplay_id", xxhash64("start_time", "user_id", "session_id"))
+    
+    # repartition by output partition columns so each year/month is written by one task, as a single file
+    songplays_table = songplays_table.repartition("year", "month")
     
-    print("Songplay table writing to parquet")
+    logger.info("Songplay table writing to parquet")
     
     # write songplays table to parquet files partitioned by year and month
     songplays_table.write.partitionBy("year", "month").parquet(f"{output_data}/songplays_table.parquet")
-    print("Writing to parquet completed!")
+    logger.info("Writing to parquet completed!")
 
 def main():
     """Main ETL body. Starts spark session and runs ETL procedures. Reads song_data and log_data from S3, transforms them to create five different tables, and writes them to partitioned parquet files in table directories on S3."""
-    print("> Starting")
+    logger.info("> Starting")
     spark = create_spark_session()
-    print("> Spark session created")
+    logger.info("> Spark session created")
     
     input_data = "s3a://udacity-dend/"
     output_data = "s3a://jp-udacity-datalake"
     
-    print("> Processing song data")
-    process_song_data(spark, input_data, output_data)
+    logger.info("> Processing song data")
+    song_df = process_song_data(spark, input_data, output_data)
+    
+    logger.info("> Processing log data")
+    process_log_data(spark, input_data, output_data, song_df)
     
-    print("> Processing log data")
-    process_log_data(spark, input_data, output_data)
+    song_df.unpersist()
     
-    print("> Finished!")
+    logger.info("> Finished!")
 
 if __name__ == "__main__":
     main()